@@ -0,0 +1,102 @@
+import asyncio
+import hashlib
+import json
+import os
+import tempfile
+import time
+from typing import Dict, Optional
+from .config import settings
+from .http_client import download_to_file
+
+# One lock per in-flight URL so concurrent requests in this process download a clip once
+_download_locks: Dict[str, asyncio.Lock] = {}
+
+def file_sha256(file_path: str, chunk_size: int = 1 << 20) -> str:
+    """Compute the SHA-256 hex digest of a file, reading it in chunks."""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _cache_path(namespace: str, key: str) -> str:
+    return os.path.join(settings.CACHE_DIR, f"{namespace}_{key}.json")
+
+def load_cached_result(namespace: str, key: str) -> Optional[dict]:
+    """Return a previously stored analysis result, or None on a miss."""
+    path = _cache_path(namespace, key)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+
+def save_cached_result(namespace: str, key: str, data: dict):
+    """Persist an analysis result; written atomically so readers never see partial JSON."""
+    path = _cache_path(namespace, key)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+def _video_cache_path(url: str) -> str:
+    return os.path.join(settings.UPLOAD_DIR, f"{hashlib.sha1(url.encode()).hexdigest()}.mp4")
+
+def _evict_videos():
+    """
+    Drop least recently used cached videos until the cache fits its size budget.
+    Files used within VIDEO_CACHE_MIN_AGE seconds are never evicted, since a
+    request (possibly in another worker) may have been handed the path and
+    not opened it yet.
+    """
+    entries = []
+    for name in os.listdir(settings.UPLOAD_DIR):
+        path = os.path.join(settings.UPLOAD_DIR, name)
+        if name.endswith(".mp4") and os.path.isfile(path):
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+    
+    total = sum(size for _, size, _ in entries)
+    cutoff = time.time() - settings.VIDEO_CACHE_MIN_AGE
+    for mtime, size, path in sorted(entries):
+        if total <= settings.MAX_VIDEO_CACHE_BYTES or mtime > cutoff:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+
+async def get_cached_video(url: str) -> str:
+    """
+    Return a local path for the video at url, downloading it only if it
+    is not already in the upload cache. Cached files must not be deleted
+    by callers; the cache evicts them on an LRU basis.
+    """
+    path = _video_cache_path(url)
+    lock = _download_locks.setdefault(url, asyncio.Lock())
+    
+    try:
+        async with lock:
+            if os.path.exists(path):
+                # Refresh mtime so eviction treats this file as recently used
+                os.utime(path)
+                return path
+            
+            # Unique temp name so workers fetching the same URL never share a file
+            fd, tmp_path = tempfile.mkstemp(suffix=".part", dir=settings.UPLOAD_DIR)
+            os.close(fd)
+            try:
+                await download_to_file(url, tmp_path)
+                os.replace(tmp_path, path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+    finally:
+        if not lock.locked() and _download_locks.get(url) is lock:
+            del _download_locks[url]
+    
+    await asyncio.to_thread(_evict_videos)
+    return path
@@ -5,8 +5,14 @@ load_dotenv()
 
 class Settings:
     GEMINI_API_KEY: str = os.getenv("GEMINI_API_KEY", "")
+    REDIS_URL: str = os.getenv("REDIS_URL", "")  # shared render job status across workers
+    ACCEL_REDIRECT_PREFIX: str = os.getenv("ACCEL_REDIRECT_PREFIX", "")  # e.g. /internal/ behind nginx
+    HW_ENCODING: bool = os.getenv("HW_ENCODING", "1") != "0"  # prefer NVENC/VideoToolbox/QSV when available
     UPLOAD_DIR: str = os.path.join(os.path.dirname(os.path.dirname(__file__)), "uploads")
     OUTPUT_DIR: str = os.path.join(os.path.dirname(os.path.dirname(__file__)), "outputs")
+    CACHE_DIR: str = os.path.join(OUTPUT_DIR, ".cache")  # Gemini analysis results by content hash
+    MAX_VIDEO_CACHE_BYTES: int = 2 * 1024 ** 3  # downloaded clips kept in UPLOAD_DIR
+    VIDEO_CACHE_MIN_AGE: float = 60 * 60  # seconds since last use before a clip may be evicted
     MAX_BROLL_INSERTIONS: int = 6
     MIN_BROLL_INSERTIONS: int = 3
     MIN_GAP_BETWEEN_INSERTIONS: float = 5.0  # seconds
@@ -14,5 +20,6 @@ class Settings:
     def __init__(self):
         os.makedirs(self.UPLOAD_DIR, exist_ok=True)
         os.makedirs(self.OUTPUT_DIR, exist_ok=True)
+        os.makedirs(self.CACHE_DIR, exist_ok=True)
 
 settings = Settings()
@@ -1,173 +1,262 @@
 import google.generativeai as genai
-import httpx
-import os
-import tempfile
-import json
+import asyncio
+import hashlib
+import logging
+import orjson
 import re
-from typing import List, Optional
+from typing import List, Optional, Tuple
 from .config import settings
 from .models import TranscriptSegment, BRollClip, BRollInsertion
+from .cache import file_sha256, get_cached_video, load_cached_result, save_cached_result
+
+logger = logging.getLogger(__name__)
+
+# Requests per analysis before giving up on clips Gemini left out of its reply
+MAX_ANALYSIS_ATTEMPTS = 2
 
 # Configure Gemini
 genai.configure(api_key=settings.GEMINI_API_KEY)
 
-async def download_video(url: str) -> str:
-    """Download video from URL to a temporary file."""
-    async with httpx.AsyncClient(timeout=120.0) as client:
-        response = await client.get(url)
-        response.raise_for_status()
-        
-        # Create temp file with .mp4 extension
-        fd, temp_path = tempfile.mkstemp(suffix=".mp4")
-        with os.fdopen(fd, 'wb') as f:
-            f.write(response.content)
-        
-        return temp_path
+# Built once and shared by every request
+_model = genai.GenerativeModel("gemini-2.5-flash-lite")
+
+# Markdown code fences Gemini sometimes wraps its JSON in
+_FENCE_RE = re.compile(r'^```(?:json)?\s*|\s*```$', re.MULTILINE)
+
+def parse_json_response(response_text: str) -> dict:
+    """Parse a JSON reply from Gemini, stripping markdown code fences if present."""
+    return orjson.loads(_FENCE_RE.sub('', response_text.strip()))
 
 def upload_to_gemini(file_path: str, mime_type: str = "video/mp4"):
     """Upload a file to Gemini and return the file object."""
     file = genai.upload_file(file_path, mime_type=mime_type)
     return file
 
-async def transcribe_a_roll(video_url: str) -> tuple[List[TranscriptSegment], float]:
+async def wait_for_file_processing(video_file):
+    """Poll Gemini until an uploaded file leaves PROCESSING, backing off exponentially."""
+    delay = 0.5
+    while video_file.state.name == "PROCESSING":
+        await asyncio.sleep(delay)
+        delay = min(delay * 1.5, 4.0)
+        video_file = await asyncio.to_thread(genai.get_file, video_file.name)
+    
+    if video_file.state.name == "FAILED":
+        raise ValueError(f"Video processing failed: {video_file.state.name}")
+    
+    return video_file
+
+async def run_videos_prompt(videos: List[Tuple[Optional[str], str]], prompt: str) -> dict:
     """
-    Transcribe A-roll video using Gemini's multimodal capabilities.
-    Returns transcript segments with timestamps and video duration.
+    Upload local videos to Gemini, run one prompt against all of them and
+    return the parsed JSON response. Each video is given as (label, path);
+    a label, when set, is placed right before its video in the request.
     """
-    # Download video
-    temp_path = await download_video(video_url)
+    # Upload to Gemini concurrently
+    uploads = await asyncio.gather(
+        *(asyncio.to_thread(upload_to_gemini, path) for _, path in videos),
+        return_exceptions=True
+    )
+    uploaded = [f for f in uploads if not isinstance(f, BaseException)]
+    pollers = []
     
     try:
-        # Upload to Gemini
-        video_file = upload_to_gemini(temp_path)
+        for result in uploads:
+            if isinstance(result, BaseException):
+                raise result
+        
+        # Wait for files to be processed
+        pollers = [asyncio.create_task(wait_for_file_processing(f)) for f in uploaded]
+        video_files = await asyncio.gather(*pollers)
         
-        # Wait for file to be processed
-        import time
-        while video_file.state.name == "PROCESSING":
-            time.sleep(2)
-            video_file = genai.get_file(video_file.name)
+        contents = []
+        for (label, _), video_file in zip(videos, video_files):
+            if label:
+                contents.append(label)
+            contents.append(video_file)
+        contents.append(prompt)
         
-        if video_file.state.name == "FAILED":
-            raise ValueError(f"Video processing failed: {video_file.state.name}")
+        response = await asyncio.to_thread(_model.generate_content, contents)
         
-        # Use Gemini to transcribe
-        model = genai.GenerativeModel("gemini-2.5-flash-lite")
+        return parse_json_response(response.text)
+    
+    finally:
+        # Stop polling files that are about to be deleted if another one failed
+        for poller in pollers:
+            poller.cancel()
+        await asyncio.gather(*pollers, return_exceptions=True)
         
-        prompt = """Analyze this video and provide a detailed transcript with timestamps.
+        # Clean up uploaded files
+        await asyncio.gather(
+            *(asyncio.to_thread(genai.delete_file, f.name) for f in uploaded),
+            return_exceptions=True
+        )
 
-The speaker may be speaking in Hinglish (Hindi-English mix). Transcribe exactly what is said.
+def b_roll_cache_key(file_hash: str, metadata: str) -> str:
+    """Cache key for a B-roll analysis: the video content plus the metadata fed to the prompt."""
+    return hashlib.sha256(f"{file_hash}:{metadata}".encode()).hexdigest()
 
-Return ONLY a valid JSON object in this exact format:
-{
-    "duration_sec": <total video duration in seconds>,
-    "segments": [
-        {
-            "start_sec": <start time in seconds>,
-            "end_sec": <end time in seconds>,
-            "text": "<transcribed text for this segment>"
-        }
+def build_transcript(data: dict) -> List[TranscriptSegment]:
+    return [
+        TranscriptSegment(
+            start_sec=seg["start_sec"],
+            end_sec=seg["end_sec"],
+            text=seg["text"]
+        )
+        for seg in data["segments"]
     ]
-}
 
-Rules:
-1. Break the transcript into sentence-level segments
-2. Each segment should be 2-8 seconds long
-3. Timestamps must be accurate to 0.5 seconds
-4. Include all spoken content
-5. Return ONLY the JSON, no other text"""
+def parse_a_roll_result(data: dict) -> tuple[List[TranscriptSegment], float]:
+    """Build the transcript and duration from an A-roll result, raising ValueError if it is malformed."""
+    try:
+        return build_transcript(data), float(data["duration_sec"])
+    except (KeyError, TypeError, ValueError) as e:
+        raise ValueError(f"Malformed A-roll transcript from Gemini: {e!r}") from e
 
-        response = model.generate_content([video_file, prompt])
-        
-        # Parse response
-        response_text = response.text.strip()
-        # Remove markdown code blocks if present
-        if response_text.startswith("```"):
-            response_text = re.sub(r'^```(?:json)?\n?', '', response_text)
-            response_text = re.sub(r'\n?```$', '', response_text)
-        
-        data = json.loads(response_text)
-        
-        segments = [
-            TranscriptSegment(
-                start_sec=seg["start_sec"],
-                end_sec=seg["end_sec"],
-                text=seg["text"]
-            )
-            for seg in data["segments"]
-        ]
-        
-        # Clean up uploaded file
-        genai.delete_file(video_file.name)
-        
-        return segments, data["duration_sec"]
-    
-    finally:
-        # Clean up temp file
-        if os.path.exists(temp_path):
-            os.remove(temp_path)
+def build_b_roll_clip(b_roll: dict, data: dict) -> BRollClip:
+    return BRollClip(
+        id=b_roll["id"],
+        url=b_roll["url"],
+        metadata=b_roll["metadata"],
+        duration_sec=data.get("duration_sec", 3.0),
+        enhanced_description=data.get("enhanced_description", b_roll["metadata"])
+    )
 
-async def analyze_b_roll(b_roll: dict) -> BRollClip:
+async def analyze_videos(
+    a_roll_url: str,
+    b_rolls: List[dict]
+) -> tuple[List[TranscriptSegment], float, List[BRollClip]]:
     """
-    Analyze a B-roll clip using Gemini Vision to enhance its description.
+    Transcribe the A-roll and analyze every B-roll with a single Gemini request.
+    Clips that already have a cached result are left out of the request, and
+    Gemini is not called at all when everything is cached. Clips missing from
+    the reply are asked for again, and a ValueError is raised if they are
+    still missing after MAX_ANALYSIS_ATTEMPTS requests.
+    Returns transcript segments, A-roll duration and analyzed B-roll clips.
     """
-    temp_path = await download_video(b_roll["url"])
+    paths = await asyncio.gather(
+        get_cached_video(a_roll_url),
+        *(get_cached_video(b_roll["url"]) for b_roll in b_rolls)
+    )
+    hashes = await asyncio.gather(*(asyncio.to_thread(file_sha256, path) for path in paths))
     
-    try:
-        # Upload to Gemini
-        video_file = upload_to_gemini(temp_path)
-        
-        # Wait for processing
-        import time
-        while video_file.state.name == "PROCESSING":
-            time.sleep(2)
-            video_file = genai.get_file(video_file.name)
+    a_roll_key = hashes[0]
+    b_roll_keys = [
+        b_roll_cache_key(file_hash, b_roll["metadata"])
+        for file_hash, b_roll in zip(hashes[1:], b_rolls)
+    ]
+    
+    a_roll = None
+    a_roll_data = load_cached_result("a_roll", a_roll_key)
+    if a_roll_data is not None:
+        try:
+            a_roll = parse_a_roll_result(a_roll_data)
+        except ValueError:
+            # Unusable cache entry; fetch a fresh transcript below
+            pass
+    
+    b_roll_data = [load_cached_result("b_roll", key) for key in b_roll_keys]
+    pending = [i for i, data in enumerate(b_roll_data) if data is None]
+    
+    for attempt in range(1, MAX_ANALYSIS_ATTEMPTS + 1):
+        if a_roll is not None and not pending:
+            break
         
-        if video_file.state.name == "FAILED":
-            raise ValueError(f"Video processing failed: {video_file.state.name}")
+        videos = []
+        tasks = []
+        schema = []
         
-        model = genai.GenerativeModel("gemini-2.5-flash-lite")
+        if a_roll is None:
+            videos.append(("A-roll video:", paths[0]))
+            tasks.append("""For the A-roll video, provide a detailed transcript with timestamps.
+The speaker may be speaking in Hinglish (Hindi-English mix). Transcribe exactly what is said.
+1. Break the transcript into sentence-level segments
+2. Each segment should be 2-8 seconds long
+3. Timestamps must be accurate to 0.5 seconds
+4. Include all spoken content""")
+            schema.append("""    "a_roll": {
+        "duration_sec": <total video duration in seconds>,
+        "segments": [
+            {
+                "start_sec": <start time in seconds>,
+                "end_sec": <end time in seconds>,
+                "text": "<transcribed text for this segment>"
+            }
+        ]
+    }""")
         
-        prompt = f"""Analyze this B-roll video clip and provide information about it.
-
-Existing metadata: {b_roll['metadata']}
-
-Return ONLY a valid JSON object in this exact format:
-{{
-    "duration_sec": <video duration in seconds>,
-    "enhanced_description": "<detailed description of visual content, mood, colors, movement, and themes>",
-    "keywords": ["<keyword1>", "<keyword2>", ...]
-}}
-
-Focus on:
+        if pending:
+            for i in pending:
+                b_roll = b_rolls[i]
+                videos.append((
+                    f"B-roll clip {b_roll['id']} (existing metadata: {b_roll['metadata']}):",
+                    paths[i + 1]
+                ))
+            tasks.append("""For each B-roll clip, describe it with a focus on:
 1. What is visually shown
 2. The mood and atmosphere
 3. Key objects and settings
-4. Visual themes that could match spoken content about food, hygiene, health, or lifestyle"""
-
-        response = model.generate_content([video_file, prompt])
+4. Visual themes that could match spoken content about food, hygiene, health, or lifestyle""")
+            schema.append("""    "b_rolls": {
+        "<B-roll clip id>": {
+            "duration_sec": <video duration in seconds>,
+            "enhanced_description": "<detailed description of visual content, mood, colors, movement, and themes>",
+            "keywords": ["<keyword1>", "<keyword2>", ...]
+        }
+    }""")
         
-        # Parse response
-        response_text = response.text.strip()
-        if response_text.startswith("```"):
-            response_text = re.sub(r'^```(?:json)?\n?', '', response_text)
-            response_text = re.sub(r'\n?```$', '', response_text)
+        tasks_text = "\n\n".join(tasks)
+        schema_text = ",\n".join(schema)
+        prompt = f"""Analyze the videos above. Each video is preceded by its label.
+
+{tasks_text}
+
+Return ONLY a valid JSON object in this exact format, with no other text:
+{{
+{schema_text}
+}}"""
         
-        data = json.loads(response_text)
+        data = await run_videos_prompt(videos, prompt)
+        if not isinstance(data, dict):
+            data = {}
         
-        # Clean up
-        genai.delete_file(video_file.name)
+        if a_roll is None:
+            # Validate before caching so a malformed reply is never persisted
+            try:
+                a_roll = parse_a_roll_result(data.get("a_roll"))
+            except ValueError as e:
+                logger.warning("Attempt %d: %s", attempt, e)
+            else:
+                save_cached_result("a_roll", a_roll_key, data["a_roll"])
         
-        return BRollClip(
-            id=b_roll["id"],
-            url=b_roll["url"],
-            metadata=b_roll["metadata"],
-            duration_sec=data.get("duration_sec", 3.0),
-            enhanced_description=data.get("enhanced_description", b_roll["metadata"])
-        )
+        returned = data.get("b_rolls")
+        if not isinstance(returned, dict):
+            returned = {}
+        for i in pending:
+            result = returned.get(b_rolls[i]["id"])
+            if isinstance(result, dict) and result:
+                save_cached_result("b_roll", b_roll_keys[i], result)
+                b_roll_data[i] = result
+        pending = [i for i in pending if b_roll_data[i] is None]
+        if pending:
+            logger.warning(
+                "Attempt %d: Gemini returned no analysis for B-roll(s) %s",
+                attempt, ", ".join(b_rolls[i]["id"] for i in pending)
+            )
     
-    finally:
-        if os.path.exists(temp_path):
-            os.remove(temp_path)
+    # Fail rather than hand the planner a transcript or clips Gemini never described
+    if a_roll is None:
+        raise ValueError("Gemini did not return a valid A-roll transcript")
+    if pending:
+        missing = ", ".join(b_rolls[i]["id"] for i in pending)
+        raise ValueError(f"Gemini did not return an analysis for B-roll(s): {missing}")
+    
+    transcript, a_roll_duration = a_roll
+    analyzed_b_rolls = [
+        build_b_roll_clip(b_roll, data)
+        for b_roll, data in zip(b_rolls, b_roll_data)
+    ]
+    
+    return transcript, a_roll_duration, analyzed_b_rolls
 
 async def generate_insertion_plan(
     transcript: List[TranscriptSegment],
@@ -177,8 +266,6 @@ async def generate_insertion_plan(
     """
     Use Gemini to generate an intelligent B-roll insertion plan.
     """
-    model = genai.GenerativeModel("gemini-2.5-flash-lite")
-    
     # Prepare transcript text
     transcript_text = "\n".join([
         f"[{seg.start_sec:.1f}s - {seg.end_sec:.1f}s]: {seg.text}"
@@ -224,15 +311,10 @@ Return ONLY a valid JSON object in this exact format:
 
 Be strategic and thoughtful about placements. The B-roll should feel natural and enhance storytelling."""
 
-    response = model.generate_content(prompt)
+    response = await asyncio.to_thread(_model.generate_content, prompt)
     
     # Parse response
-    response_text = response.text.strip()
-    if response_text.startswith("```"):
-        response_text = re.sub(r'^```(?:json)?\n?', '', response_text)
-        response_text = re.sub(r'\n?```$', '', response_text)
-    
-    data = json.loads(response_text)
+    data = parse_json_response(response.text)
     
     insertions = [
         BRollInsertion(
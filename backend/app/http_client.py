@@ -0,0 +1,37 @@
+import aiofiles
+import httpx
+from typing import Optional
+
+# Chunk size for streaming downloads to disk
+DOWNLOAD_CHUNK_SIZE = 1 << 16
+
+# Shared client so downloads reuse pooled keep-alive connections
+_client: Optional[httpx.AsyncClient] = None
+
+def get_http_client() -> httpx.AsyncClient:
+    """Return the shared HTTP client, creating it on first use."""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            http2=True,
+            timeout=120.0,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=20)
+        )
+    return _client
+
+async def close_http_client():
+    """Close the shared HTTP client and release pooled connections."""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+async def download_to_file(url: str, output_path: str) -> str:
+    """Stream a URL to disk in chunks without buffering the whole body."""
+    client = get_http_client()
+    async with client.stream("GET", url) as response:
+        response.raise_for_status()
+        async with aiofiles.open(output_path, 'wb') as f:
+            async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                await f.write(chunk)
+    return output_path
@@ -0,0 +1,47 @@
+import orjson
+import redis.asyncio as redis
+from typing import Dict, Optional
+from .config import settings
+
+# Finished jobs are kept for a day so clients can still poll their status
+JOB_TTL_SECONDS = 24 * 60 * 60
+
+class JobStore:
+    """
+    Render job status store. Backed by Redis when REDIS_URL is set, so every
+    uvicorn worker sees the same jobs and they survive restarts; otherwise
+    falls back to an in-process dict for single-worker local development.
+    """
+    
+    def __init__(self):
+        self._redis: Optional[redis.Redis] = None
+        self._local: Dict[str, dict] = {}
+    
+    async def connect(self):
+        if settings.REDIS_URL:
+            self._redis = redis.from_url(settings.REDIS_URL)
+            await self._redis.ping()
+    
+    async def close(self):
+        if self._redis is not None:
+            await self._redis.aclose()
+            self._redis = None
+    
+    async def set(self, job_id: str, status: dict):
+        """Replace the stored status of a job."""
+        if self._redis is None:
+            self._local[job_id] = status
+            return
+        
+        # Stored as one JSON value so types round-trip the same as the dict backend
+        await self._redis.set(f"job:{job_id}", orjson.dumps(status), ex=JOB_TTL_SECONDS)
+    
+    async def get(self, job_id: str) -> Optional[dict]:
+        """Return the status of a job, or None if it is unknown."""
+        if self._redis is None:
+            return self._local.get(job_id)
+        
+        status = await self._redis.get(f"job:{job_id}")
+        return orjson.loads(status) if status is not None else None
+
+job_store = JobStore()
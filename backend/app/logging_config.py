@@ -0,0 +1,25 @@
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+
+def setup_logging(level: int = logging.INFO) -> QueueListener:
+    """
+    Route all app.* loggers through a queue so request handlers only enqueue
+    records; a background listener thread does the actual stream writes.
+    Returns the started listener, which should be stopped on shutdown.
+    """
+    log_queue = queue.SimpleQueue()
+    
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(
+        logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s")
+    )
+    
+    app_logger = logging.getLogger("app")
+    app_logger.setLevel(level)
+    app_logger.handlers = [QueueHandler(log_queue)]
+    app_logger.propagate = False
+    
+    listener = QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    return listener
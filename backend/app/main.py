@@ -1,20 +1,26 @@
 import json
+import logging
 import os
+import orjson
 from fastapi import FastAPI, HTTPException, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, Response
 from typing import Optional
 import asyncio
+import uuid
 
 from .models import (
     TimelinePlan, PlanRequest, BRollClip, 
     TranscriptSegment, BRollInsertion
 )
-from .gemini_service import (
-    transcribe_a_roll, analyze_b_roll, generate_insertion_plan
-)
-from .video_renderer import render_final_video
+from .gemini_service import analyze_videos, generate_insertion_plan
+from .video_renderer import render_final_video, detect_video_encoder
 from .config import settings
+from .http_client import close_http_client
+from .job_store import job_store
+from .logging_config import setup_logging
+
+logger = logging.getLogger(__name__)
 
 app = FastAPI(
     title="Flona AI - B-Roll Insertion System",
@@ -31,8 +37,19 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Store for processing status
-processing_status = {}
+@app.on_event("startup")
+async def startup():
+    app.state.log_listener = setup_logging()
+    await job_store.connect()
+    # Probe FFmpeg encoders once so renders don't pay for it
+    encoder = await asyncio.to_thread(detect_video_encoder)
+    logger.info("Using video encoder: %s", encoder)
+
+@app.on_event("shutdown")
+async def shutdown():
+    await close_http_client()
+    await job_store.close()
+    app.state.log_listener.stop()
 
 def load_sample_data():
     """Load sample video URLs from JSON file."""
@@ -74,33 +91,28 @@ async def generate_plan(request: PlanRequest):
         a_roll_data = data["a_roll"]
         b_rolls_data = data["b_rolls"]
         
-        # Step 1: Transcribe A-roll
-        print("Transcribing A-roll...")
-        transcript, a_roll_duration = await transcribe_a_roll(a_roll_data["url"])
-        print(f"Transcription complete. Duration: {a_roll_duration}s, Segments: {len(transcript)}")
-        
-        # Step 2: Analyze B-rolls (with rate limiting)
-        print("Analyzing B-roll clips...")
-        analyzed_b_rolls = []
-        for b_roll in b_rolls_data:
-            print(f"  Analyzing {b_roll['id']}...")
-            analyzed = await analyze_b_roll(b_roll)
-            analyzed_b_rolls.append(analyzed)
-            await asyncio.sleep(1)  # Rate limiting
-        print(f"B-roll analysis complete. Analyzed: {len(analyzed_b_rolls)} clips")
+        # Steps 1 & 2: Transcribe A-roll and analyze B-rolls in one Gemini request
+        logger.info("Analyzing A-roll and B-roll clips...")
+        transcript, a_roll_duration, analyzed_b_rolls = await analyze_videos(
+            a_roll_url=a_roll_data["url"],
+            b_rolls=b_rolls_data
+        )
+        logger.info("Transcription complete. Duration: %ss, Segments: %d", a_roll_duration, len(transcript))
+        logger.info("B-roll analysis complete. Analyzed: %d clips", len(analyzed_b_rolls))
         
         # Step 3: Generate insertion plan
-        print("Generating insertion plan...")
+        logger.info("Generating insertion plan...")
         insertions = await generate_insertion_plan(
             transcript=transcript,
             a_roll_duration=a_roll_duration,
             b_rolls=analyzed_b_rolls
         )
-        print(f"Plan generated. Insertions: {len(insertions)}")
+        logger.info("Plan generated. Insertions: %d", len(insertions))
         
         # Build response
         timeline_plan = TimelinePlan(
             a_roll_duration=a_roll_duration,
+            a_roll_url=a_roll_data["url"],
             transcript=transcript,
             insertions=insertions,
             b_rolls=analyzed_b_rolls
@@ -108,13 +120,13 @@ async def generate_plan(request: PlanRequest):
         
         # Save to file
         output_path = os.path.join(settings.OUTPUT_DIR, "timeline_plan.json")
-        with open(output_path, 'w') as f:
-            f.write(timeline_plan.model_dump_json(indent=2))
+        with open(output_path, 'wb') as f:
+            f.write(orjson.dumps(timeline_plan.model_dump(mode="json"), option=orjson.OPT_INDENT_2))
         
         return timeline_plan
     
     except Exception as e:
-        print(f"Error generating plan: {e}")
+        logger.exception("Error generating plan: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/render-video")
@@ -123,27 +135,30 @@ async def render_video(plan: TimelinePlan, background_tasks: BackgroundTasks):
     Render the final video with B-roll insertions.
     This runs in the background and returns a job ID.
     """
-    job_id = f"render_{int(asyncio.get_event_loop().time() * 1000)}"
-    processing_status[job_id] = {"status": "processing", "progress": 0}
+    # Random suffix keeps IDs unique across workers sharing the job store
+    job_id = f"render_{uuid.uuid4().hex[:12]}"
+    await job_store.set(job_id, {"status": "processing", "progress": 0})
     
     async def do_render():
         try:
-            # Load sample data to get URLs
-            data = load_sample_data()
+            # Use the A-roll the plan was generated from so its download is
+            # reused from the upload cache; older plans fall back to sample data
+            a_roll_url = plan.a_roll_url or load_sample_data()["a_roll"]["url"]
             
             output_path = await render_final_video(
-                a_roll_url=data["a_roll"]["url"],
+                a_roll_url=a_roll_url,
                 b_rolls=plan.b_rolls,
                 insertions=plan.insertions,
                 output_filename=f"{job_id}.mp4"
             )
-            processing_status[job_id] = {
+            await job_store.set(job_id, {
                 "status": "completed",
                 "output_path": output_path,
                 "download_url": f"/download/{job_id}.mp4"
-            }
+            })
         except Exception as e:
-            processing_status[job_id] = {"status": "failed", "error": str(e)}
+            logger.exception("Render %s failed: %s", job_id, e)
+            await job_store.set(job_id, {"status": "failed", "error": str(e)})
     
     background_tasks.add_task(do_render)
     
@@ -152,9 +167,10 @@ async def render_video(plan: TimelinePlan, background_tasks: BackgroundTasks):
 @app.get("/render-status/{job_id}")
 async def get_render_status(job_id: str):
     """Check the status of a render job."""
-    if job_id not in processing_status:
+    status = await job_store.get(job_id)
+    if status is None:
         raise HTTPException(status_code=404, detail="Job not found")
-    return processing_status[job_id]
+    return status
 
 @app.get("/download/{filename}")
 async def download_video(filename: str):
@@ -162,6 +178,16 @@ async def download_video(filename: str):
     file_path = os.path.join(settings.OUTPUT_DIR, filename)
     if not os.path.exists(file_path):
         raise HTTPException(status_code=404, detail="File not found")
+    
+    if settings.ACCEL_REDIRECT_PREFIX:
+        # Let the reverse proxy stream the file with sendfile instead of Python
+        return Response(
+            media_type="video/mp4",
+            headers={
+                "X-Accel-Redirect": f"{settings.ACCEL_REDIRECT_PREFIX.rstrip('/')}/{filename}",
+                "Content-Disposition": f'attachment; filename="{filename}"'
+            }
+        )
     return FileResponse(file_path, media_type="video/mp4", filename=filename)
 
 @app.get("/timeline-plan")
@@ -171,5 +197,6 @@ async def get_saved_plan():
     if not os.path.exists(plan_path):
         raise HTTPException(status_code=404, detail="No saved plan found")
     
-    with open(plan_path, 'r') as f:
-        return json.load(f)
+    # Serve the saved bytes as-is instead of parsing and re-serializing them
+    with open(plan_path, 'rb') as f:
+        return Response(content=f.read(), media_type="application/json")
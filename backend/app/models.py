@@ -28,6 +28,7 @@ class BRollInsertion(BaseModel):
 
 class TimelinePlan(BaseModel):
     a_roll_duration: float
+    a_roll_url: Optional[str] = None
     transcript: List[TranscriptSegment]
     insertions: List[BRollInsertion]
     b_rolls: List[BRollClip]
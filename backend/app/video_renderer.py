@@ -1,35 +1,134 @@
+import asyncio
+import json
+import logging
 import subprocess
 import os
-import tempfile
-import httpx
-from typing import List
+from functools import lru_cache
+from typing import List, Tuple
 from .models import BRollInsertion, BRollClip
 from .config import settings
+from .cache import get_cached_video
+
+logger = logging.getLogger(__name__)
 
 # Transition duration in seconds for smooth crossfades
 TRANSITION_DURATION = 0.3
 
-async def download_video_file(url: str, output_path: str) -> str:
-    """Download video from URL to specified path."""
-    async with httpx.AsyncClient(timeout=120.0) as client:
-        response = await client.get(url)
-        response.raise_for_status()
-        with open(output_path, 'wb') as f:
-            f.write(response.content)
-    return output_path
+# H.264 encoders in order of preference, with comparable quality settings
+VIDEO_ENCODER_ARGS = {
+    "h264_nvenc": ["-preset", "p5", "-rc", "vbr", "-cq", "23"],
+    "h264_videotoolbox": ["-q:v", "55"],
+    "h264_qsv": ["-preset", "medium", "-global_quality", "23"],
+    "libx264": ["-preset", "medium", "-crf", "20"],
+}
+SOFTWARE_ENCODER = "libx264"
+
+# Clips are short H.264 MP4s, so a small probe is enough to find their streams
+INPUT_PROBE_ARGS = ["-probesize", "1M", "-analyzeduration", "1M"]
+
+# Run the filter graph on every core
+FILTER_THREADS = str(os.cpu_count() or 1)
+
+# Seconds to wait on each encoder probe; a hung GPU driver must not hang startup
+ENCODER_PROBE_TIMEOUT = 10
+
+# Set once a hardware render fails, so this process stops trying the hardware path
+_hw_encoder_failed = False
+
+@lru_cache(maxsize=None)
+def detect_video_encoder() -> str:
+    """Return the first usable hardware H.264 encoder, falling back to libx264."""
+    if not settings.HW_ENCODING or _hw_encoder_failed:
+        return SOFTWARE_ENCODER
+    
+    try:
+        result = subprocess.run(
+            ["ffmpeg", "-hide_banner", "-encoders"],
+            capture_output=True,
+            text=True,
+            timeout=ENCODER_PROBE_TIMEOUT
+        )
+    except (OSError, subprocess.TimeoutExpired):
+        return SOFTWARE_ENCODER
+    
+    for encoder in VIDEO_ENCODER_ARGS:
+        if encoder == SOFTWARE_ENCODER or f" {encoder} " not in result.stdout:
+            continue
+        # An encoder can be compiled in without the device to back it,
+        # so confirm it with a tiny test encode
+        try:
+            probe = subprocess.run(
+                [
+                    "ffmpeg", "-hide_banner", "-v", "error",
+                    "-f", "lavfi", "-i", "color=size=256x256:duration=0.1",
+                    "-c:v", encoder, "-f", "null", "-"
+                ],
+                capture_output=True,
+                timeout=ENCODER_PROBE_TIMEOUT
+            )
+        except subprocess.TimeoutExpired:
+            continue
+        if probe.returncode == 0:
+            return encoder
+    
+    return SOFTWARE_ENCODER
+
+def disable_hw_encoder():
+    """Make detect_video_encoder return libx264 for the rest of this process."""
+    global _hw_encoder_failed
+    _hw_encoder_failed = True
+    detect_video_encoder.cache_clear()
+
+def build_render_cmd(input_paths: List[str], filter_complex: str, output_path: str, encoder: str) -> List[str]:
+    """Build the FFmpeg render command for the given video encoder."""
+    inputs = []
+    for path in input_paths:
+        if encoder != SOFTWARE_ENCODER:
+            # Let FFmpeg offload decoding too when a hardware encoder is in use
+            inputs.extend(["-hwaccel", "auto"])
+        inputs.extend([*INPUT_PROBE_ARGS, "-i", path])
+    
+    return [
+        "ffmpeg", "-y",
+        "-filter_threads", FILTER_THREADS,
+        "-filter_complex_threads", FILTER_THREADS,
+        *inputs,
+        "-filter_complex", filter_complex,
+        "-map", "[vout]",
+        "-map", "0:a",  # Keep A-roll audio continuous
+        "-c:v", encoder,
+        *VIDEO_ENCODER_ARGS[encoder],
+        "-threads", "0",
+        "-c:a", "aac",
+        "-b:a", "192k",
+        "-movflags", "+faststart",
+        output_path
+    ]
+
+async def run_process(cmd: List[str]) -> Tuple[int, str, str]:
+    """Run a subprocess without blocking the event loop; returns (returncode, stdout, stderr)."""
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    stdout, stderr = await proc.communicate()
+    return proc.returncode, stdout.decode(errors="replace"), stderr.decode(errors="replace")
 
-def get_video_info(file_path: str) -> dict:
-    """Get video width, height, and fps using ffprobe."""
+async def get_video_info(file_path: str) -> dict:
+    """Get video width, height, fps and duration with a single ffprobe call."""
     probe_cmd = [
         "ffprobe", "-v", "error",
         "-select_streams", "v:0",
-        "-show_entries", "stream=width,height,r_frame_rate",
+        "-show_entries", "stream=width,height,r_frame_rate:format=duration",
         "-of", "json",
         file_path
     ]
-    result = subprocess.run(probe_cmd, capture_output=True, text=True)
-    import json
-    data = json.loads(result.stdout)
+    returncode, stdout, stderr = await run_process(probe_cmd)
+    if returncode != 0:
+        raise RuntimeError(f"FFprobe error: {stderr}")
+    
+    data = json.loads(stdout)
     stream = data["streams"][0]
     
     # Parse frame rate (could be "30/1" or "30000/1001")
@@ -39,7 +138,8 @@ def get_video_info(file_path: str) -> dict:
     return {
         "width": stream["width"],
         "height": stream["height"],
-        "fps": fps
+        "fps": fps,
+        "duration": float(data["format"]["duration"])
     }
 
 async def render_final_video(
@@ -49,148 +149,173 @@ async def render_final_video(
     output_filename: str = "final_output.mp4"
 ) -> str:
     """
-    Render final video with B-roll overlays using FFmpeg.
+    Render final video with B-roll insertions using FFmpeg.
     A-roll audio remains continuous throughout.
-    Uses segment-based approach with crossfade transitions.
+    Splits the A-roll at insertion points, swaps in the B-roll for each
+    covered interval and concatenates the segments in a single pass.
     """
-    temp_dir = tempfile.mkdtemp()
+    # Only B-rolls some insertion refers to are fetched; with no insertions
+    # the render below is a stream copy and never touches B-roll URLs
+    referenced_ids = {insertion.broll_id for insertion in insertions}
+    used_b_rolls = list({
+        b_roll.id: b_roll for b_roll in b_rolls if b_roll.id in referenced_ids
+    }.values())
     
-    try:
-        # Download A-roll
-        a_roll_path = os.path.join(temp_dir, "a_roll.mp4")
-        await download_video_file(a_roll_url, a_roll_path)
-        
-        # Download all B-rolls
-        b_roll_paths = {}
-        for b_roll in b_rolls:
-            b_roll_path = os.path.join(temp_dir, f"{b_roll.id}.mp4")
-            await download_video_file(b_roll.url, b_roll_path)
-            b_roll_paths[b_roll.id] = b_roll_path
-        
-        # Get A-roll video info
-        a_roll_info = get_video_info(a_roll_path)
-        width = a_roll_info["width"]
-        height = a_roll_info["height"]
-        fps = a_roll_info["fps"]
-        
-        # Sort insertions by start time
-        sorted_insertions = sorted(insertions, key=lambda x: x.start_sec)
-        
-        # Build input list
-        inputs = ["-i", a_roll_path]
-        for insertion in sorted_insertions:
-            b_roll_path = b_roll_paths.get(insertion.broll_id)
-            if b_roll_path:
-                inputs.extend(["-i", b_roll_path])
-        
-        # Build filter complex using a different approach:
-        # 1. Prepare each B-roll: scale, trim to duration, and set proper fps
-        # 2. For each B-roll insertion, create a segment that fades in/out
-        # 3. Overlay the B-roll segments on top of A-roll at the correct times
-        
-        filter_parts = []
-        
-        # Prepare A-roll base with consistent fps
-        filter_parts.append(f"[0:v]fps={fps},format=yuv420p[aroll]")
-        
-        # Prepare each B-roll with scaling, timing, and fade transitions
-        for i, insertion in enumerate(sorted_insertions):
-            input_idx = i + 1
-            duration = insertion.duration_sec
-            fade_in_start = 0
+    # Fetch A-roll and the used B-rolls concurrently; clips already pulled
+    # in by /generate-plan are served straight from the upload cache
+    a_roll_path, *b_roll_files = await asyncio.gather(
+        get_cached_video(a_roll_url),
+        *[get_cached_video(b_roll.url) for b_roll in used_b_rolls]
+    )
+    b_roll_paths = {
+        b_roll.id: path for b_roll, path in zip(used_b_rolls, b_roll_files)
+    }
+    
+    # Get A-roll video info
+    a_roll_info = await get_video_info(a_roll_path)
+    width = a_roll_info["width"]
+    height = a_roll_info["height"]
+    fps = a_roll_info["fps"]
+    
+    a_roll_duration = a_roll_info["duration"]
+    
+    # Sort insertions by start time, keeping only those with a downloaded clip
+    sorted_insertions = sorted(
+        (ins for ins in insertions if ins.broll_id in b_roll_paths),
+        key=lambda x: x.start_sec
+    )
+    
+    # Build the output as a sequence of segments that are concatenated once:
+    # A-roll intervals between insertions, and a B-roll clip in place of each
+    # covered interval. Overlapping insertions are clipped to start where the
+    # previous one ends, and nothing runs past the end of the A-roll.
+    # Everything is counted in whole frames on the A-roll's fps grid, so the
+    # concatenated pieces add up to exactly the A-roll's frame count and the
+    # video cannot drift from the continuous A-roll audio.
+    frame_count = round(a_roll_duration * fps)
+    segments = []  # ("a", start_frame, end_frame) or ("b", broll_id, frames)
+    cursor = 0
+    for insertion in sorted_insertions:
+        start = max(round(insertion.start_sec * fps), cursor)
+        end = min(round((insertion.start_sec + insertion.duration_sec) * fps), frame_count)
+        if end <= start:
+            continue
+        if start > cursor:
+            segments.append(("a", cursor, start))
+        segments.append(("b", insertion.broll_id, end - start))
+        cursor = end
+    if cursor < frame_count:
+        segments.append(("a", cursor, None))
+    
+    # Build input list with each B-roll file passed (and decoded) only once,
+    # however many times it is inserted
+    b_roll_uses = {}
+    for segment in segments:
+        if segment[0] == "b":
+            b_roll_uses[segment[1]] = b_roll_uses.get(segment[1], 0) + 1
+    
+    # Output path
+    output_path = os.path.join(settings.OUTPUT_DIR, output_filename)
+    
+    # Nothing to insert: remux the A-roll as-is instead of re-encoding it
+    if not b_roll_uses:
+        cmd = [
+            "ffmpeg", "-y",
+            *INPUT_PROBE_ARGS,
+            "-i", a_roll_path,
+            "-c", "copy",
+            "-movflags", "+faststart",
+            output_path
+        ]
+        logger.info("No B-roll insertions, copying A-roll streams...")
+        returncode, _, stderr = await run_process(cmd)
+        if returncode != 0:
+            logger.error("FFmpeg stderr: %s", stderr)
+            raise RuntimeError(f"FFmpeg error: {stderr}")
+        return output_path
+    
+    input_paths = [a_roll_path]
+    idx_of = {}
+    for broll_id in b_roll_uses:
+        input_paths.append(b_roll_paths[broll_id])
+        idx_of[broll_id] = len(input_paths) - 1
+    
+    filter_parts = []
+    a_segment_count = sum(1 for seg in segments if seg[0] == "a")
+    
+    # Decode the A-roll once and fan it out to each of its intervals
+    if a_segment_count:
+        a_labels = "".join(f"[a{j}]" for j in range(a_segment_count))
+        filter_parts.append(
+            f"[0:v]fps={fps},format=yuv420p,setsar=1,split={a_segment_count}{a_labels}"
+        )
+    
+    # Scale each B-roll to match A-roll once, then fan it out to its insertions
+    for broll_id, uses in b_roll_uses.items():
+        input_idx = idx_of[broll_id]
+        b_labels = "".join(f"[b{input_idx}_{j}]" for j in range(uses))
+        filter_parts.append(
+            f"[{input_idx}:v]"
+            f"fps={fps},"
+            f"scale={width}:{height}:force_original_aspect_ratio=decrease,"
+            f"pad={width}:{height}:(ow-iw)/2:(oh-ih)/2:color=black,"
+            f"setsar=1,"
+            f"format=yuv420p,"
+            f"split={uses}{b_labels}"
+        )
+    
+    a_idx = 0
+    b_idx = {broll_id: 0 for broll_id in b_roll_uses}
+    for k, segment in enumerate(segments):
+        if segment[0] == "a":
+            _, start, end = segment
+            trim = f"trim=start_frame={start}" + (f":end_frame={end}" if end is not None else "")
+            filter_parts.append(f"[a{a_idx}]{trim},setpts=PTS-STARTPTS[s{k}]")
+            a_idx += 1
+        else:
+            _, broll_id, frames = segment
+            duration = frames / fps
             fade_out_start = max(0, duration - TRANSITION_DURATION)
             
-            # Scale B-roll to match A-roll, set fps, trim to duration, add fade in/out
-            # Use setpts to reset timestamps so B-roll plays from the beginning
+            # Play B-roll from its start, hold its last frame if it is shorter
+            # than the slot so A-roll audio stays in sync, then fade in/out
             filter_parts.append(
-                f"[{input_idx}:v]"
-                f"fps={fps},"
-                f"scale={width}:{height}:force_original_aspect_ratio=decrease,"
-                f"pad={width}:{height}:(ow-iw)/2:(oh-ih)/2:color=black,"
+                f"[b{idx_of[broll_id]}_{b_idx[broll_id]}]"
                 f"setpts=PTS-STARTPTS,"
-                f"trim=duration={duration},"
+                f"tpad=stop_mode=clone:stop_duration={duration},"
+                f"trim=end_frame={frames},"
                 f"setpts=PTS-STARTPTS,"
-                f"format=yuv420p,"
-                f"fade=t=in:st={fade_in_start}:d={TRANSITION_DURATION},"
+                f"fade=t=in:st=0:d={TRANSITION_DURATION},"
                 f"fade=t=out:st={fade_out_start}:d={TRANSITION_DURATION}"
-                f"[b{i}]"
+                f"[s{k}]"
             )
-        
-        # Create overlay chain - overlay each B-roll at its start time
-        # The key is to use setpts to delay the B-roll to start at the right time,
-        # then use overlay with eof_action to handle when B-roll ends
-        
-        current_base = "[aroll]"
-        for i, insertion in enumerate(sorted_insertions):
-            # Delay the B-roll to start at insertion.start_sec
-            # Then overlay it on the current base
-            delayed_broll = f"[b{i}delayed]"
-            filter_parts.append(
-                f"[b{i}]setpts=PTS+{insertion.start_sec}/TB{delayed_broll}"
-            )
-            
-            next_output = f"[v{i}]" if i < len(sorted_insertions) - 1 else "[vout]"
-            
-            # Overlay with shortest=0 so A-roll continues after B-roll ends
-            # eof_action=pass means continue showing base when overlay ends
-            filter_parts.append(
-                f"{current_base}{delayed_broll}overlay=0:0:eof_action=pass{next_output}"
-            )
-            current_base = next_output
-        
-        # Handle case with no insertions
-        if not sorted_insertions:
-            filter_parts.append("[aroll]copy[vout]")
-        
-        filter_complex = ";".join(filter_parts)
-        
-        # Output path
-        output_path = os.path.join(settings.OUTPUT_DIR, output_filename)
-        
-        # Build FFmpeg command
-        cmd = [
-            "ffmpeg", "-y",
-            *inputs,
-            "-filter_complex", filter_complex,
-            "-map", "[vout]",
-            "-map", "0:a",  # Keep A-roll audio continuous
-            "-c:v", "libx264",
-            "-preset", "medium",
-            "-crf", "20",
-            "-c:a", "aac",
-            "-b:a", "192k",
-            "-movflags", "+faststart",
-            output_path
-        ]
-        
-        print(f"Running FFmpeg command...")
-        print(f"Filter complex: {filter_complex}")
-        
-        # Run FFmpeg
-        process = subprocess.run(
-            cmd,
-            capture_output=True,
-            text=True
+            b_idx[broll_id] += 1
+    
+    segment_labels = "".join(f"[s{k}]" for k in range(len(segments)))
+    filter_parts.append(f"{segment_labels}concat=n={len(segments)}:v=1:a=0[vout]")
+    
+    filter_complex = ";".join(filter_parts)
+    
+    encoder = detect_video_encoder()
+    cmd = build_render_cmd(input_paths, filter_complex, output_path, encoder)
+    
+    logger.info("Running FFmpeg command with %s...", encoder)
+    logger.debug("Filter complex: %s", filter_complex)
+    
+    # Run FFmpeg
+    returncode, _, stderr = await run_process(cmd)
+    
+    if returncode != 0 and encoder != SOFTWARE_ENCODER:
+        logger.warning(
+            "%s render failed, retrying with %s and using it for later renders",
+            encoder, SOFTWARE_ENCODER
         )
-        
-        if process.returncode != 0:
-            print(f"FFmpeg stderr: {process.stderr}")
-            raise RuntimeError(f"FFmpeg error: {process.stderr}")
-        
-        return output_path
+        disable_hw_encoder()
+        cmd = build_render_cmd(input_paths, filter_complex, output_path, SOFTWARE_ENCODER)
+        returncode, _, stderr = await run_process(cmd)
     
-    finally:
-        # Cleanup temp files
-        import shutil
-        shutil.rmtree(temp_dir, ignore_errors=True)
-
-def get_video_duration(file_path: str) -> float:
-    """Get video duration using FFprobe."""
-    cmd = [
-        "ffprobe", "-v", "error",
-        "-show_entries", "format=duration",
-        "-of", "default=noprint_wrappers=1:nokey=1",
-        file_path
-    ]
-    result = subprocess.run(cmd, capture_output=True, text=True)
-    return float(result.stdout.strip())
+    if returncode != 0:
+        logger.error("FFmpeg stderr: %s", stderr)
+        raise RuntimeError(f"FFmpeg error: {stderr}")
+    
+    return output_path